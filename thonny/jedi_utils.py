@@ -3,6 +3,7 @@
 Because of Debian Stretch, Thonny needs to support jedi 0.10,
 which doesn't use separate parso
 """
+import logging
 
 
 def import_python_tree():
@@ -118,6 +119,36 @@ def parse_source(source):
         return get_module_node(script)
 
 
+def parse_source_incrementally(source, previous_tree=None, previous_source=None):
+    """Given the tree of a previous version of the source, reparses only the changed part.
+    Returned tree may be the previous one, updated in place.
+
+    The caller keeps the trees (parso's own diff cache would keep them until the end
+    of the process)."""
+    try:
+        import parso
+        from parso.utils import split_lines
+    except ImportError:
+        # older jedi
+        return parse_source(source)
+
+    grammar = parso.load_grammar()
+    if previous_tree is not None:
+        try:
+            # Diff parser is not part of parso's public API
+            diff_parser = grammar._diff_parser(
+                grammar._pgen_grammar, grammar._tokenizer, previous_tree
+            )
+            return diff_parser.update(
+                old_lines=split_lines(previous_source, keepends=True),
+                new_lines=split_lines(source, keepends=True),
+            )
+        except Exception:
+            logging.getLogger("thonny").debug("Could not reparse incrementally", exc_info=True)
+
+    return grammar.parse(source)
+
+
 def get_version_tuple():
     import jedi
 
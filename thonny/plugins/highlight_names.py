@@ -1,4 +1,7 @@
+import bisect
 import logging
+import re
+import sys
 import tkinter as tk
 import traceback
 
@@ -7,30 +10,75 @@ from thonny import jedi_utils
 
 tree = None
 
+NAME_CHAR_REGEX = re.compile(r"\w")
+
 
 class BaseNameHighlighter:
     def __init__(self, text):
         self.text = text
         self._update_scheduled = False
+        self._current_source = None
+        self._cached_source = None
+        self._cached_module_node = None
 
     def get_positions_for(self, source, line, column):
         raise NotImplementedError()
 
     def get_positions(self):
-        index = self.text.index("insert")
+        return self.get_positions_batch(["insert"])[0]
+
+    def get_positions_batch(self, indices):
+        """Returns positions for each of the given cursor indices.
+        The source is fetched from the widget at most once."""
+        source = None
+        result = []
+        for index in map(self.text.index, indices):
+            # ignore if cursor in open string
+            if self.text.tag_prevrange("open_string", index) or self.text.tag_prevrange(
+                "open_string3", index
+            ):
+                result.append(set())
+                continue
 
-        # ignore if cursor in open string
-        if self.text.tag_prevrange("open_string", index) or self.text.tag_prevrange(
-            "open_string3", index
-        ):
+            # A name under the cursor must touch the cursor from left or right.
+            # This check is much cheaper than fetching and analyzing the whole source.
+            if not NAME_CHAR_REGEX.search(self.text.get(index + "-1c", index + "+1c")):
+                result.append(set())
+                continue
 
-            return set()
+            if source is None:
+                source = self._get_source()
 
-        source = self.text.get("1.0", "end")
-        index_parts = index.split(".")
-        line, column = int(index_parts[0]), int(index_parts[1])
+            line, column = _parse_index(index)
+            result.append(self.get_positions_for(source, line, column))
 
-        return self.get_positions_for(source, line, column)
+        return result
+
+    def _get_source(self):
+        if self._current_source is None:
+            self._current_source = self.text.get("1.0", "end")
+
+        return self._current_source
+
+    def invalidate_source(self):
+        """Needs to be called after each change in the text,
+        otherwise highlighter keeps working with the source it fetched last time"""
+        self._current_source = None
+
+    def _get_module_node(self, source):
+        # Cursor moves don't change the source, so the tree can be reused
+        if source != self._cached_source:
+            # Edits usually touch only a small part of the source
+            self._cached_module_node = jedi_utils.parse_source_incrementally(
+                source, self._cached_module_node, self._cached_source
+            )
+            self._cached_source = source
+            self._index_module_node(self._cached_module_node)
+
+        return self._cached_module_node
+
+    def _index_module_node(self, module_node):
+        pass
 
     def schedule_update(self):
         def perform_update():
@@ -50,9 +98,9 @@ class BaseNameHighlighter:
             try:
                 positions = self.get_positions()
                 if len(positions) > 1:
-                    for pos in positions:
-                        start_index, end_index = pos[0], pos[1]
-                        self.text.tag_add("matched_name", start_index, end_index)
+                    # Tk accepts several ranges in one call
+                    indices = [index for pos in positions for index in pos[:2]]
+                    self.text.tag_add("matched_name", *indices)
             except Exception:
                 logging.exception("Problem when updating name highlighting")
 
@@ -61,6 +109,14 @@ class VariablesHighlighter(BaseNameHighlighter):
     """This is heavy, but more correct solution for variables, than Script.usages provides 
     (at least for Jedi 0.10)"""
 
+    def __init__(self, text):
+        super().__init__(text)
+        self._name_starts = []
+        self._name_leaves = []
+        self._name_starts_by_value = {}
+        self._last_name = None
+        self._last_positions = frozenset()
+
     def _is_name_function_call_name(self, name):
         stmt = name.get_definition()
         return stmt.type == "power" and stmt.children[0] == name
@@ -99,6 +155,48 @@ class VariablesHighlighter(BaseNameHighlighter):
                         traceback.print_exc()
         return None
 
+    def _index_module_node(self, module_node):
+        # Name leaves are indexed once per parse and looked up with binary search
+        leaves = []
+
+        def collect_names(node):
+            # Leaves are handled in the loop, only inner nodes cost a call
+            for child in node.children:
+                if isinstance(child, tree.Name):
+                    # Equal names become identical strings, so that comparisons
+                    # during usage search can succeed without comparing characters
+                    child.value = sys.intern(child.value)
+                    leaves.append(child)
+                elif isinstance(child, tree.BaseNode):
+                    collect_names(child)
+
+        collect_names(module_node)
+        self._name_starts = [leaf.start_pos for leaf in leaves]
+        self._name_leaves = leaves
+        # filled lazily, usually only the name under cursor gets queried
+        self._name_starts_by_value = {}
+
+        self._last_name = None
+        self._last_positions = frozenset()
+
+    def _get_name_of_position(self, pos):
+        i = bisect.bisect_right(self._name_starts, pos) - 1
+        if i >= 0 and pos <= self._name_leaves[i].end_pos:
+            return self._name_leaves[i]
+        else:
+            return None
+
+    def _node_contains_name(self, node, name_str):
+        """Tells whether there is an occurrence of the name inside the node
+        (according to the index built by _index_module_node)"""
+        starts = self._name_starts_by_value.get(name_str)
+        if starts is None:
+            starts = [leaf.start_pos for leaf in self._name_leaves if leaf.value == name_str]
+            self._name_starts_by_value[name_str] = starts
+
+        i = bisect.bisect_left(starts, node.start_pos)
+        return i < len(starts) and starts[i] < node.end_pos
+
     def _is_global_stmt_with_name(self, node, name_str):
         return (
             isinstance(node, tree.BaseNode)
@@ -162,11 +260,19 @@ class VariablesHighlighter(BaseNameHighlighter):
             return self._find_def_in_simple_node(c, name)
 
     def _get_dot_names(self, stmt):
-        try:
-            if stmt.children[1].children[0].value == ".":
-                return stmt.children[0], stmt.children[1].children[1]
-        except Exception:
+        # This gets called for every node visited by usage search,
+        # so leaves are rejected without raising and catching exceptions
+        if not isinstance(stmt, tree.BaseNode) or len(stmt.children) < 2:
             return ()
+
+        trailer = stmt.children[1]
+        if (
+            isinstance(trailer, tree.BaseNode)
+            and len(trailer.children) > 1
+            and getattr(trailer.children[0], "value", None) == "."
+        ):
+            return stmt.children[0], trailer.children[1]
+
         return ()
 
     def _find_usages(self, name, stmt):
@@ -187,6 +293,10 @@ class VariablesHighlighter(BaseNameHighlighter):
         def find_usages_in_node(node, global_encountered=False):
             names = []
             if isinstance(node, tree.BaseNode):
+                if not self._node_contains_name(node, name.value):
+                    # nothing to find or define here
+                    return names
+
                 if jedi_utils.is_scope(node):
                     global_encountered = False
                     if node in searched_scopes:
@@ -255,27 +365,30 @@ class VariablesHighlighter(BaseNameHighlighter):
         return usages
 
     def get_positions_for(self, source, line, column):
-        module_node = jedi_utils.parse_source(source)
+        module_node = self._get_module_node(source)
         pos = (line, column)
-        stmt = self._get_statement_for_position(module_node, pos)
+        name = self._get_name_of_position(pos)
+        if not name:
+            return set()
 
-        name = None
-        if isinstance(stmt, tree.Name):
-            name = stmt
-        elif isinstance(stmt, tree.BaseNode):
-            name = jedi_utils.get_name_of_position(stmt, pos)
+        if name is self._last_name:
+            # cursor moved within the same name
+            return self._last_positions
 
-        if not name:
+        stmt = self._get_statement_for_position(module_node, pos)
+        if stmt is None:
             return set()
 
         # format usage positions as tkinter text widget indices
-        return set(
+        self._last_positions = frozenset(
             (
                 "%d.%d" % (usage.start_pos[0], usage.start_pos[1]),
                 "%d.%d" % (usage.start_pos[0], usage.start_pos[1] + len(name.value)),
             )
             for usage in self._find_usages(name, stmt)
         )
+        self._last_name = name
+        return self._last_positions
 
 
 class UsagesHighlighter(BaseNameHighlighter):
@@ -315,6 +428,13 @@ class CombinedHighlighter(VariablesHighlighter, UsagesHighlighter):
         return usages | variables
 
 
+def _parse_index(index):
+    """Splits a normalized Tk index ("line.column") into ints
+    without allocating a list like str.split does"""
+    dot_pos = index.index(".")
+    return int(index[:dot_pos]), int(index[dot_pos + 1 :])
+
+
 def update_highlighting(event):
     if not get_workbench().ready:
         # don't slow down loading process
@@ -342,9 +462,16 @@ def update_highlighting(event):
     text.name_highlighter.schedule_update()
 
 
+def handle_text_change(event):
+    if hasattr(event.widget, "name_highlighter"):
+        event.widget.name_highlighter.invalidate_source()
+
+    update_highlighting(event)
+
+
 def load_plugin() -> None:
     wb = get_workbench()
     wb.set_default("view.name_highlighting", False)
     wb.bind_class("CodeViewText", "<<CursorMove>>", update_highlighting, True)
-    wb.bind_class("CodeViewText", "<<TextChange>>", update_highlighting, True)
+    wb.bind_class("CodeViewText", "<<TextChange>>", handle_text_change, True)
     wb.bind("<<UpdateAppearance>>", update_highlighting, True)
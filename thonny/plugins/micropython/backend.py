@@ -56,13 +56,17 @@ from thonny.plugins.micropython.connection import ConnectionClosedException
 from textwrap import dedent, indent
 import ast
 import re
-from queue import Queue, Empty
+from queue import Queue
 import threading
 import os
 import time
 import io
+import atexit
+import json
+import unicodedata
 from thonny.running import EXPECTED_TERMINATION_CODE
 from threading import Lock
+from collections import namedtuple
 
 ENCODING = "utf-8"
 
@@ -74,6 +78,13 @@ VALUE_REPR_START = b"<repr>"
 VALUE_REPR_END = b"</repr>"
 EOT = b"\x04"
 MGMT_VALUE_START = b"\x02"
+MGMT_VALUE_START_STR = MGMT_VALUE_START.decode(ENCODING)
+
+# for wrapping an expression so that its value gets printed after MGMT_VALUE_START
+PRINT_MGMT_VALUE_PREFIX = "__thonny_helper.print_mgmt_value("
+# (JSON printing is part of the file system helpers)
+PRINT_MGMT_JSON_PREFIX = "__thonny_fs_helper.print_mgmt_json("
+PRINT_MGMT_VALUE_SUFFIX = ")"
 
 # first prompt when switching to raw mode (or after soft reboot in raw mode)
 # Looks like it's not translatable in CP
@@ -90,12 +101,31 @@ WAIT_OR_CRASH_TIMEOUT = 5
 
 SECONDS_IN_YEAR = 60 * 60 * 24 * 365
 
+# Dotted name before cursor, eg. "machine.Pin.IR"
+# https://github.com/takluyver/ubit_kernel/blob/master/ubit_kernel/kernel.py
+AUTOCOMPLETE_TAIL_REGEX = re.compile(r"(\w+\.)*(\w+)?$")
+
+# Listing upload sources uses several threads only if there are more subdirectories
+# than this after the first level
+PARALLEL_LOCAL_SCAN_THRESHOLD = 4
+LOCAL_SCAN_WORKERS = min(16, (os.cpu_count() or 1) * 2)
+
+# How long to collect events (eg. output fragments) before writing them out together
+MESSAGE_BATCHING_DELAY = 0.005
+
+# commands which can be handled while another command is running
+SIDE_COMMAND_TYPES = (InputSubmission, EOFCommand)
+
+DEBUG = False
+
+TransferItem = namedtuple("TransferItem", ["source", "target", "size"])
+
 logger = logging.getLogger("thonny.micropython.backend")
 
 
-def debug(msg):
-    return
-    print(msg, file=sys.stderr)
+def debug(*args):
+    if DEBUG:
+        print(*args, file=sys.stderr)
 
 
 class MicroPythonBackend:
@@ -106,9 +136,30 @@ class MicroPythonBackend:
         self._local_cwd = None
         self._cwd = None
         self._command_queue = Queue()  # populated by reader thread
-        self._progress_times = {}
+        # remote directories known to exist (valid only during one command, because
+        # the user's code may change the file system)
+        self._known_remote_dirs = set()
+        self._last_listed_paths_repr = None
+        self._listed_paths_generation = 0
+        self._activity_wakeup_pending = False
+        self._connection.set_activity_listener(self._on_connection_activity)
 
         self._api_stubs_path = api_stubs_path
+        self._all_helpers = None
+        self._file_system_helpers_script = None
+        self._file_system_helpers_installed = False
+        self._json_supported = None
+        self._encoded_all_helpers = None
+
+        self._stdout_binary = sys.stdout.buffer
+        self._pending_messages = []
+        self._messages_lock = Lock()
+        self._messages_available = threading.Event()
+        self._message_flushing_thread = threading.Thread(
+            target=self._flush_messages_periodically, daemon=True
+        )
+        self._message_flushing_thread.start()
+        atexit.register(self._flush_messages)
 
         self._command_reading_thread = threading.Thread(target=self._read_commands, daemon=True)
         self._command_reading_thread.start()
@@ -141,6 +192,19 @@ class MicroPythonBackend:
         self._report_time("prepared")
 
     def _get_all_helpers(self):
+        # The script doesn't change, but it may be needed again after a soft reboot
+        if self._all_helpers is None:
+            self._all_helpers = self._create_all_helpers()
+
+        return self._all_helpers
+
+    def _get_encoded_all_helpers(self):
+        if self._encoded_all_helpers is None:
+            self._encoded_all_helpers = self._get_all_helpers().encode(ENCODING)
+
+        return self._encoded_all_helpers
+
+    def _create_all_helpers(self):
         # Can't import functions into class context:
         # https://github.com/micropython/micropython/issues/6198
         return (
@@ -162,7 +226,7 @@ class MicroPythonBackend:
                 @staticmethod
                 def print_mgmt_value(obj):
                     print({mgmt_marker!r}, repr(obj), sep='', end='')
-                    
+                
                 @classmethod
                 def listdir(cls, x):
                     if hasattr(cls.os, "listdir"):
@@ -174,12 +238,148 @@ class MicroPythonBackend:
                 num_values_to_keep=self._get_num_values_to_keep(),
                 start_marker=OBJECT_LINK_START,
                 end_marker=OBJECT_LINK_END,
-                mgmt_marker=MGMT_VALUE_START.decode(ENCODING),
+                mgmt_marker=MGMT_VALUE_START_STR,
             )
             + "\n"
             + indent(self._get_custom_helpers(), "    ")
         )
 
+    def _ensure_file_system_helpers(self):
+        """File browser and transfer helpers get installed on first use, so that sessions
+        not using them don't spend device memory and soft reboot time on them"""
+        if self._file_system_helpers_installed:
+            return
+
+        script = self._get_file_system_helpers_script()
+        out, err = self._execute(script, capture_output=True)
+        if out or err:
+            self._handle_bad_output(script, out, err)
+        else:
+            self._file_system_helpers_installed = True
+
+    def _get_file_system_helpers_script(self):
+        if self._file_system_helpers_script is None:
+            self._file_system_helpers_script = self._create_file_system_helpers_script()
+
+        return self._file_system_helpers_script
+
+    def _create_file_system_helpers_script(self):
+        return (
+            dedent(
+                """
+            class __thonny_fs_helper(__thonny_helper):
+                try:
+                    import ujson as json
+                except ImportError:
+                    try:
+                        import json
+                    except ImportError:
+                        json = None
+                
+                @classmethod
+                def print_mgmt_json(cls, obj):
+                    print({mgmt_marker!r}, cls.json.dumps(obj), sep='', end='')
+            """
+            ).format(mgmt_marker=MGMT_VALUE_START_STR)
+            + "\n"
+            + indent(self._get_file_system_helpers(), "    ")
+        )
+
+    def _get_file_system_helpers(self):
+        # defined once per session, so that file browsing and transfers don't need
+        # to submit (and later delete) their functions every time
+        return dedent(
+            """
+            @classmethod
+            def getsize(cls, path):
+                if hasattr(cls.os, "stat"):
+                    return cls.os.stat(path)[6]
+                else:
+                    # micro:bit
+                    return cls.os.size(path)
+            
+            @classmethod
+            def isdir(cls, path):
+                if hasattr(cls.os, "stat"):
+                    return cls.os.stat(path)[0] & 0o170000 == 0o040000
+                else:
+                    return False
+            
+            @classmethod
+            def rec_list_with_size(cls, path):
+                result = {}
+                if cls.isdir(path):
+                    for name in cls.listdir(path):
+                        result.update(cls.rec_list_with_size(path + "/" + name))
+                else:
+                    result[path] = cls.getsize(path)
+                
+                return result
+            
+            @classmethod
+            def get_existing_paths(cls, paths, probe_func_name):
+                probe = getattr(cls.os, probe_func_name)
+                result = []
+                for path in paths:
+                    try:
+                        probe(path)
+                        result.append(path)
+                    except OSError:
+                        pass
+                
+                return result
+            
+            # paths of last get_dirs_child_data call and a key identifying them
+            listed_paths = None
+            listed_paths_key = None
+            
+            @classmethod
+            def get_dirs_child_data(cls, paths, paths_key):
+                if paths is None:
+                    # caller wants to list same paths again
+                    if paths_key != cls.listed_paths_key:
+                        return None
+                    paths = cls.listed_paths
+                else:
+                    cls.listed_paths = paths
+                    cls.listed_paths_key = paths_key
+                
+                result = {}
+                for path in paths:
+                    real_path = path or '/'
+                    try:
+                        child_names = cls.listdir(real_path)
+                    except OSError:
+                        # probably deleted directory
+                        children = None
+                    else:
+                        children = {}
+                        prefix = real_path if real_path.endswith('/') else real_path + '/'
+                        for name in child_names:
+                            if name.startswith('.') or name == "System Volume Information":
+                                continue
+                            full = prefix + name
+                            try:
+                                st = cls.os.stat(full)
+                                if st[0] & 0o170000 == 0o040000:
+                                    # directory
+                                    children[name] = {"kind" : "dir", "size" : None}
+                                else:
+                                    children[name] = {"kind" : "file", "size" : st[6]}
+                                
+                                # converting from 2000-01-01 epoch to Unix epoch 
+                                children[name]["time"] = max(st[8], st[9]) + 946684800
+                            except OverflowError:
+                                # Probably "System Volume Information" in trinket
+                                # https://github.com/thonny/thonny/issues/923
+                                pass
+                    
+                    result[path] = children
+                
+                return result
+        """
+        )
+
     def _get_custom_helpers(self):
         return ""
 
@@ -194,21 +394,27 @@ class MicroPythonBackend:
     def _mainloop(self):
         while True:
             self._check_for_connection_errors()
-            try:
-                cmd = self._command_queue.get(timeout=0.1)
-            except Empty:
-                # No command in queue, but maybe a thread produced output meanwhile
+            cmd = self._command_queue.get()
+
+            if isinstance(cmd, ConnectionActivity):
+                # No command, but maybe a thread produced output meanwhile
                 # or the user resetted the device
+                self._activity_wakeup_pending = False
                 self._forward_unexpected_output()
-                continue
-
-            if isinstance(cmd, InputSubmission):
+            elif isinstance(cmd, InputSubmission):
                 self._submit_input(cmd.data)
             elif isinstance(cmd, EOFCommand):
                 self._soft_reboot(False)
             else:
                 self.handle_command(cmd)
 
+    def _on_connection_activity(self):
+        "works in connection's reader thread"
+        # one pending wakeup is enough for forwarding all output received meanwhile
+        if not self._activity_wakeup_pending:
+            self._activity_wakeup_pending = True
+            self._command_queue.put(ConnectionActivity())
+
     def _fetch_welcome_text(self):
         raise NotImplementedError()
 
@@ -234,15 +440,25 @@ class MicroPythonBackend:
     def _send_ready_message(self):
         self.send_message(ToplevelResponse(welcome_text=self._welcome_text, cwd=self._cwd))
 
-    def _check_send_inline_progress(self, cmd, value, maximum, description=None):
-        assert "id" in cmd
-        prev_time = self._progress_times.get(cmd["id"], 0)
-        if value != maximum and time.time() - prev_time < 0.2:
-            # Don't notify too often
-            return
-        else:
-            self._progress_times[cmd["id"]] = time.time()
+    def _create_inline_progress_notifier(self, cmd, maximum):
+        """Returns a function for reporting the progress of this command.
+        Intermediate values are reported at most after every 0.2 seconds."""
+        prev_time = 0
+
+        def notify(value):
+            nonlocal prev_time
+            if value != maximum:
+                current_time = time.time()
+                if current_time - prev_time < 0.2:
+                    # Don't notify too often
+                    return
+                prev_time = current_time
 
+            self._send_inline_progress(cmd, value, maximum)
+
+        return notify
+
+    def _send_inline_progress(self, cmd, value, maximum, description=None):
         if description is None:
             description = cmd.get("description", "Working...")
 
@@ -291,6 +507,8 @@ class MicroPythonBackend:
         if "local_cwd" in cmd:
             self._local_cwd = cmd["local_cwd"]
 
+        self._known_remote_dirs.clear()
+
         def create_error_response(**kw):
             if not "error" in kw:
                 kw["error"] = traceback.format_exc()
@@ -346,7 +564,7 @@ class MicroPythonBackend:
         if "id" in cmd and "command_id" not in response:
             response["command_id"] = cmd["id"]
 
-        debug("cmd: " + str(cmd) + ", respin: " + str(response))
+        debug("cmd:", cmd, "respin:", response)
         self.send_message(response)
 
         self._report_time("after " + cmd.name)
@@ -356,11 +574,10 @@ class MicroPythonBackend:
         assert self._connection.outgoing_is_empty()
 
         assert cdata.endswith("\n")
-        if not cdata.endswith("\r\n"):
-            # submission is done with CRLF
-            cdata = cdata[:-1] + "\r\n"
-
         bdata = cdata.encode(ENCODING)
+        if not bdata.endswith(b"\r\n"):
+            # submission is done with CRLF
+            bdata = bdata[:-1] + b"\r\n"
 
         with self._writing_lock:
             self._connection.write(bdata)
@@ -383,8 +600,40 @@ class MicroPythonBackend:
         if "cwd" not in msg:
             msg["cwd"] = self._cwd
 
-        sys.stdout.write(serialize_message(msg) + "\n")
-        sys.stdout.flush()
+        with self._messages_lock:
+            self._pending_messages.append(msg)
+
+        if isinstance(msg, BackendEvent):
+            # Events (eg. output and progress) may come in large numbers,
+            # so they get written out in batches
+            self._messages_available.set()
+        else:
+            # Responses should reach the front-end without delay
+            self._flush_messages()
+
+    def _flush_messages(self):
+        with self._messages_lock:
+            self._messages_available.clear()
+            if not self._pending_messages:
+                return
+
+            payload = "".join(serialize_message(msg) + "\n" for msg in self._pending_messages)
+            self._pending_messages = []
+
+            # write while holding the lock to keep the order of messages.
+            # Text written via sys.stdout (eg. by print) must go out before the payload.
+            sys.stdout.flush()
+            self._stdout_binary.write(payload.encode(ENCODING))
+            self._stdout_binary.flush()
+
+    def _flush_messages_periodically(self):
+        "works in separate thread"
+
+        while True:
+            self._messages_available.wait()
+            # give following events a chance to join the batch
+            time.sleep(MESSAGE_BATCHING_DELAY)
+            self._flush_messages()
 
     def _send_output(self, data, stream_name):
         if not data:
@@ -394,6 +643,19 @@ class MicroPythonBackend:
             data = data.decode(ENCODING, errors="replace")
 
         data = self._transform_output(data)
+
+        with self._messages_lock:
+            if self._pending_messages:
+                last_msg = self._pending_messages[-1]
+                if (
+                    isinstance(last_msg, BackendEvent)
+                    and last_msg.event_type == "ProgramOutput"
+                    and last_msg.stream_name == stream_name
+                ):
+                    # previous fragment is not written out yet, so this can be joined to it
+                    last_msg.data += data
+                    return
+
         msg = BackendEvent(event_type="ProgramOutput", stream_name=stream_name, data=data)
         self.send_message(msg)
 
@@ -405,19 +667,24 @@ class MicroPythonBackend:
 
     def _execute(self, script, capture_output):
         if capture_output:
-            output_lists = {"stdout": [], "stderr": []}
-
-            def consume_output(data, stream_name):
-                output_lists[stream_name].append(data)
-
-            self._execute_with_consumer(script, consume_output)
             return [
-                b"".join(output_lists[name]).decode(ENCODING, errors="replace")
-                for name in ["stdout", "stderr"]
+                data.decode(ENCODING, errors="replace")
+                for data in self._execute_and_capture_bytes(script)
             ]
         else:
             self._execute_with_consumer(script, self._send_output)
 
+    def _execute_and_capture_bytes(self, script):
+        output_buffers = {"stdout": bytearray(), "stderr": bytearray()}
+
+        def consume_output(data, stream_name):
+            if isinstance(data, str):
+                data = data.encode(ENCODING)
+            output_buffers[stream_name].extend(data)
+
+        self._execute_with_consumer(script, consume_output)
+        return output_buffers["stdout"], output_buffers["stderr"]
+
     def _execute_with_consumer(self, script, output_consumer):
         """Ensures prompt and submits the script.
         Reads (and doesn't return) until next prompt or connection error.
@@ -439,37 +706,57 @@ class MicroPythonBackend:
         if out or err:
             self._handle_bad_output(script, out, err)
 
-    def _evaluate(self, script):
+    def _evaluate(self, script, json_value=False):
         """Evaluate the output of the script or raise ProtocolError, if anything looks wrong.
         
         Adds printing code if the script contains single expression and doesn't 
-        already contain printing code"""
-        try:
-            ast.parse(script, mode="eval")
-            prefix = "__thonny_helper.print_mgmt_value("
-            suffix = ")"
-            if not script.strip().startswith(prefix):
-                script = prefix + script + suffix
-        except SyntaxError:
-            pass
+        already contain printing code.
+        
+        With json_value the value of the expression gets transferred as JSON (quicker to parse
+        than repr for large values). Caller must make sure the device supports it."""
+        prefix = PRINT_MGMT_JSON_PREFIX if json_value else PRINT_MGMT_VALUE_PREFIX
+        if not script.lstrip().startswith(prefix):
+            try:
+                ast.parse(script, mode="eval")
+                script = prefix + script + PRINT_MGMT_VALUE_SUFFIX
+            except SyntaxError:
+                pass
+
+        out, err = self._execute_and_capture_bytes(script)
+
+        def handle_bad_output():
+            return self._handle_bad_output(
+                script,
+                out.decode(ENCODING, errors="replace"),
+                err.decode(ENCODING, errors="replace"),
+            )
 
-        out, err = self._execute(script, capture_output=True)
         if err:
-            return self._handle_bad_output(script, out, err)
+            return handle_bad_output()
 
-        if MGMT_VALUE_START.decode(ENCODING) not in out:
-            return self._handle_bad_output(script, out, err)
+        # Only the part after the marker needs decoding.
+        # (UTF-8 never uses ASCII bytes inside multibyte sequences, so splitting bytes is safe)
+        value_start = out.rfind(MGMT_VALUE_START)
+        if value_start == -1:
+            return handle_bad_output()
 
-        side_effects, value_str = out.rsplit(MGMT_VALUE_START.decode(ENCODING), maxsplit=1)
-        if side_effects:
+        if value_start > 0:
             logging.getLogger("thonny").warning(
-                "Unexpected output from MP evaluate:\n" + side_effects
+                "Unexpected output from MP evaluate:\n"
+                + out[:value_start].decode(ENCODING, errors="replace")
             )
 
+        value_str = out[value_start + len(MGMT_VALUE_START) :].decode(ENCODING, errors="replace")
+        if json_value:
+            try:
+                return json.loads(value_str)
+            except ValueError:
+                return handle_bad_output()
+
         try:
             return ast.literal_eval(value_str)
         except SyntaxError:
-            return self._handle_bad_output(script, out, err)
+            return handle_bad_output()
 
     def _forward_output_until_active_prompt(self, stream_name="stdout"):
         """Used for finding initial prompt or forwarding problematic output 
@@ -485,19 +772,20 @@ class MicroPythonBackend:
         if self._command_queue.empty():
             return
 
-        postponed = []
-        while not self._command_queue.empty():
-            cmd = self._command_queue.get()
+        # take out side commands in one go, leaving other commands in the queue in original order
+        with self._command_queue.mutex:
+            pending = self._command_queue.queue
+            side_commands = [cmd for cmd in pending if isinstance(cmd, SIDE_COMMAND_TYPES)]
+            if side_commands:
+                other_commands = [cmd for cmd in pending if not isinstance(cmd, SIDE_COMMAND_TYPES)]
+                pending.clear()
+                pending.extend(other_commands)
+
+        for cmd in side_commands:
             if isinstance(cmd, InputSubmission):
                 self._submit_input(cmd.data)
-            elif isinstance(cmd, EOFCommand):
-                self._soft_reboot(True)
             else:
-                postponed.append(cmd)
-
-        # put back postponed commands
-        while postponed:
-            self._command_queue.put(postponed.pop(0))
+                self._soft_reboot(True)
 
     def _supports_directories(self):
         # NB! make sure self._cwd is queried first
@@ -575,11 +863,11 @@ class MicroPythonBackend:
             assert file["path"].startswith(file["original_context"])
             path_suffix = file["path"][len(file["original_context"]) :].strip("/").strip("\\")
             target_path = os.path.join(target_dir, os.path.normpath(path_suffix))
-            download_items.append(dict(source=file["path"], target=target_path, size=file["size"]))
+            download_items.append(TransferItem(file["path"], target_path, file["size"]))
 
         if not cmd["allow_overwrite"]:
-            targets = [item["target"] for item in download_items]
-            existing_files = list(filter(os.path.exists, targets))
+            targets = [item.target for item in download_items]
+            existing_files = _get_existing_local_files(targets)
             if existing_files:
                 return {
                     "existing_files": existing_files,
@@ -588,18 +876,18 @@ class MicroPythonBackend:
                     "description": cmd["description"],
                 }
 
+        notify_total_progress = self._create_inline_progress_notifier(cmd, total_size)
+
         def notify(current_file_progress):
-            self._check_send_inline_progress(
-                cmd, completed_files_size + current_file_progress, total_size
-            )
+            notify_total_progress(completed_files_size + current_file_progress)
 
         # replace the indeterminate progressbar with determinate as soon as possible
         notify(0)
 
         for item in download_items:
-            written_bytes = self._download_file(item["source"], item["target"], notify)
-            assert written_bytes == item["size"]
-            completed_files_size += item["size"]
+            written_bytes = self._download_file(item.source, item.target, notify)
+            assert written_bytes == item.size
+            completed_files_size += item.size
 
     def _cmd_upload(self, cmd):
         completed_files_size = 0
@@ -615,10 +903,10 @@ class MicroPythonBackend:
             assert file["path"].startswith(file["original_context"])
             path_suffix = file["path"][len(file["original_context"]) :].strip("/").strip("\\")
             target_path = self._join_remote_path_parts(target_dir, to_remote_path(path_suffix))
-            upload_items.append(dict(source=file["path"], target=target_path, size=file["size"]))
+            upload_items.append(TransferItem(file["path"], target_path, file["size"]))
 
         if not cmd["allow_overwrite"]:
-            targets = [item["target"] for item in upload_items]
+            targets = [item.target for item in upload_items]
             existing_files = self._get_existing_remote_files(targets)
             if existing_files:
                 return {
@@ -628,20 +916,20 @@ class MicroPythonBackend:
                     "description": cmd["description"],
                 }
 
-        total_size = sum([item["size"] for item in upload_items])
+        total_size = sum(item.size for item in upload_items)
+
+        notify_total_progress = self._create_inline_progress_notifier(cmd, total_size)
 
         def notify(current_file_progress):
-            self._check_send_inline_progress(
-                cmd, completed_files_size + current_file_progress, total_size
-            )
+            notify_total_progress(completed_files_size + current_file_progress)
 
         # replace the indeterminate progressbar with determinate as soon as possible
         notify(0)
 
         for item in upload_items:
-            written_bytes = self._upload_file(item["source"], item["target"], notify)
-            assert written_bytes == item["size"]
-            completed_files_size += item["size"]
+            written_bytes = self._upload_file(item.source, item.target, notify)
+            assert written_bytes == item.size
+            completed_files_size += item.size
 
     def _cmd_mkdir(self, cmd):
         raise NotImplementedError()
@@ -669,10 +957,12 @@ class MicroPythonBackend:
             if completion.name.startswith("__"):
                 continue
 
-            if completion.parent() and completion.full_name:
-                parent_name = completion.parent().name
+            parent = completion.parent()
+            full_name = completion.full_name
+            if parent and full_name:
+                parent_name = parent.name
                 name = completion.name
-                root = completion.full_name.split(".")[0]
+                root = full_name.split(".", 1)[0]
 
                 # jedi proposes names from CPython builtins
                 if root in self._builtins_info and name not in self._builtins_info[root]:
@@ -710,9 +1000,7 @@ class MicroPythonBackend:
             return response
         else:
             # use live data
-            match = re.search(
-                r"(\w+\.)*(\w+)?$", source
-            )  # https://github.com/takluyver/ubit_kernel/blob/master/ubit_kernel/kernel.py
+            match = AUTOCOMPLETE_TAIL_REGEX.search(source)
             if match:
                 prefix = match.group()
                 if "." in prefix:
@@ -759,6 +1047,7 @@ class MicroPythonBackend:
             )
         )
 
+        created_dirs = set()
         for module_name in sorted(self._fetch_builtin_modules()):
             if (
                 not module_name.startswith("_")
@@ -768,25 +1057,33 @@ class MicroPythonBackend:
                 file_name = os.path.join(
                     self._api_stubs_path, module_name.replace(".", "/") + ".py"
                 )
-                self._dump_module_stubs(module_name, file_name)
+                self._dump_module_stubs(module_name, file_name, created_dirs)
 
-    def _dump_module_stubs(self, module_name, file_name):
+    def _dump_module_stubs(self, module_name, file_name, created_dirs):
         self._execute_without_output("import {0}".format(module_name))
 
-        os.makedirs(os.path.dirname(file_name), exist_ok=True)
+        # query the device first and then write the file in one go
+        stubs = io.StringIO()
+        if module_name not in [
+            "webrepl",
+            "_webrepl",
+            "gc",
+            "http_client",
+            "http_client_ssl",
+            "http_server",
+            "framebuf",
+            "example_pub_button",
+            "flashbdev",
+        ]:
+            self._dump_object_stubs(stubs, module_name, "")
+
+        dir_name = os.path.dirname(file_name)
+        if dir_name not in created_dirs:
+            os.makedirs(dir_name, exist_ok=True)
+            created_dirs.add(dir_name)
+
         with io.open(file_name, "w", encoding="utf-8", newline="\n") as fp:
-            if module_name not in [
-                "webrepl",
-                "_webrepl",
-                "gc",
-                "http_client",
-                "http_client_ssl",
-                "http_server",
-                "framebuf",
-                "example_pub_button",
-                "flashbdev",
-            ]:
-                self._dump_object_stubs(fp, module_name, "")
+            fp.write(stubs.getvalue())
 
     def _dump_object_stubs(self, fp, object_expr, indent):
         if object_expr in [
@@ -831,78 +1128,75 @@ class MicroPythonBackend:
                 fp.write(indent + name + " = None\n")
 
     def _list_local_files_with_info(self, paths):
-        def rec_list_with_size(path):
-            result = {}
-            if os.path.isfile(path):
-                result[path] = os.path.getsize(path)
-            elif os.path.isdir(path):
-                for name in os.listdir(path):
-                    result.update(rec_list_with_size(os.path.join(path, name)))
-            else:
-                raise RuntimeError("Can't process " + path)
+        result = []
 
-            return result
+        def add_file(path, size, original_context):
+            result.append({"path": path, "size": size, "original_context": original_context})
+
+        def scan_dir(path, original_context):
+            """Returns file records and subdirectories of one directory.
+            scandir entries know their kind, so files need only one stat (for the size)"""
+            files = []
+            subdirs = []
+            for entry in os.scandir(path):
+                if entry.is_file():
+                    files.append(
+                        {
+                            "path": entry.path,
+                            "size": entry.stat().st_size,
+                            "original_context": original_context,
+                        }
+                    )
+                elif entry.is_dir():
+                    subdirs.append((entry.path, original_context))
+                else:
+                    raise RuntimeError("Can't process " + entry.path)
 
-        result = []
+            return files, subdirs
+
+        pending_dirs = []
         for requested_path in paths:
-            sizes = rec_list_with_size(requested_path)
-            for path in sizes:
-                result.append(
-                    {
-                        "path": path,
-                        "size": sizes[path],
-                        "original_context": os.path.dirname(requested_path),
-                    }
-                )
+            original_context = os.path.dirname(requested_path)
+            if os.path.isfile(requested_path):
+                add_file(requested_path, os.path.getsize(requested_path), original_context)
+            elif os.path.isdir(requested_path):
+                files, subdirs = scan_dir(requested_path, original_context)
+                result.extend(files)
+                pending_dirs.extend(subdirs)
+            else:
+                raise RuntimeError("Can't process " + requested_path)
+
+        if len(pending_dirs) > PARALLEL_LOCAL_SCAN_THRESHOLD:
+            # worth keeping several directory reads in flight (eg. on a network drive)
+            from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+            with ThreadPoolExecutor(max_workers=LOCAL_SCAN_WORKERS) as executor:
+                futures = {executor.submit(scan_dir, *item) for item in pending_dirs}
+                while futures:
+                    done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        files, subdirs = future.result()
+                        result.extend(files)
+                        futures.update(executor.submit(scan_dir, *item) for item in subdirs)
+        else:
+            while pending_dirs:
+                files, subdirs = scan_dir(*pending_dirs.pop())
+                result.extend(files)
+                pending_dirs.extend(subdirs)
 
         result.sort(key=lambda rec: rec["path"])
         return result
 
     def _list_remote_files_with_info(self, paths):
-        # prepare universal functions
-        self._execute_without_output(
-            dedent(
-                """
-            try:
-                
-                from os import stat as __tthonny_stat
-                
-                def __thonny_getsize(path):
-                    return __thonny_helper.os.stat(path)[6]
-                
-                def __thonny_isdir(path):
-                    return __thonny_helper.os.stat(path)[0] & 0o170000 == 0o040000
-                    
-            except ImportError:
-                __thonny_helper.os.stat = None
-                # micro:bit
-                from os import size as __thonny_getsize
-                
-                def __thonny_isdir(path):
-                    return False
-        """
-            )
-        )
-
-        self._execute_without_output(
-            dedent(
-                """
-            def __thonny_rec_list_with_size(path):
-                result = {}
-                if __thonny_isdir(path):
-                    for name in __thonny_helper.listdir(path):
-                        result.update(__thonny_rec_list_with_size(path + "/" + name))
-                else:
-                    result[path] = __thonny_getsize(path)
-    
-                return result
-        """
-            )
+        self._ensure_file_system_helpers()
+        # list all requested paths in one round trip
+        sizes_by_requested_path = self._evaluate(
+            "{path: __thonny_fs_helper.rec_list_with_size(path) for path in %r}" % list(paths)
         )
 
         result = []
         for requested_path in paths:
-            sizes = self._evaluate("__thonny_rec_list_with_size(%r)" % requested_path)
+            sizes = sizes_by_requested_path[requested_path]
             for path in sizes:
                 result.append(
                     {
@@ -913,17 +1207,6 @@ class MicroPythonBackend:
                 )
 
         result.sort(key=lambda rec: rec["path"])
-
-        self._execute_without_output(
-            dedent(
-                """
-                
-                del __thonny_getsize
-                del __thonny_isdir
-                del __thonny_rec_list_with_size
-            """
-            )
-        )
         return result
 
     def _get_existing_remote_files(self, paths):
@@ -932,24 +1215,8 @@ class MicroPythonBackend:
         else:
             func = "size"
 
-        return self._evaluate(
-            dedent(
-                """
-                
-                __thonny_result = []
-                for __thonny_path in %r:
-                    try:
-                        __thonny_helper.os.%s(__thonny_path)
-                        __thonny_result.append(__thonny_path)
-                    except OSError:
-                        pass
-                __thonny_helper.print_mgmt_value(__thonny_result)
-                del __thonny_result
-                del __thonny_path
-                """
-            )
-            % (paths, func),
-        )
+        self._ensure_file_system_helpers()
+        return self._evaluate("__thonny_fs_helper.get_existing_paths(%r, %r)" % (paths, func))
 
     def _join_remote_path_parts(self, left, right):
         if left == "":  # micro:bit
@@ -968,66 +1235,39 @@ class MicroPythonBackend:
         raise NotImplementedError()
 
     def _get_dirs_child_data_generic(self, paths):
-        return self._evaluate(
-            dedent(
-                """
-                
-                # Init all vars, so that they can be deleted
-                # even if the loop makes no iterations
-                __thonny_result = {}
-                __thonny_path = None
-                __thonny_st = None 
-                __thonny_child_names = None
-                __thonny_children = None
-                __thonny_name = None
-                __thonny_real_path = None
-                __thonny_full = None
-                
-                for __thonny_path in %(paths)r:
-                    __thonny_real_path = __thonny_path or '/'
-                    try:
-                        __thonny_child_names = __thonny_helper.listdir(__thonny_real_path)
-                    except OSError:
-                        # probably deleted directory
-                        __thonny_children = None
-                    else:
-                        __thonny_children = {}
-                        for __thonny_name in __thonny_child_names:
-                            if __thonny_name.startswith('.') or __thonny_name == "System Volume Information":
-                                continue
-                            __thonny_full = (__thonny_real_path + '/' + __thonny_name).replace("//", "/")
-                            try:
-                                __thonny_st = __thonny_helper.os.stat(__thonny_full)
-                                if __thonny_st[0] & 0o170000 == 0o040000:
-                                    # directory
-                                    __thonny_children[__thonny_name] = {"kind" : "dir", "size" : None}
-                                else:
-                                    __thonny_children[__thonny_name] = {"kind" : "file", "size" :__thonny_st[6]}
-                                
-                                # converting from 2000-01-01 epoch to Unix epoch 
-                                __thonny_children[__thonny_name]["time"] = max(__thonny_st[8], __thonny_st[9]) + 946684800
-                            except OverflowError:
-                                # Probably "System Volume Information" in trinket
-                                # https://github.com/thonny/thonny/issues/923
-                                pass
-                            
-                    __thonny_result[__thonny_path] = __thonny_children
-                
-                
-                __thonny_helper.print_mgmt_value(__thonny_result)
-                                       
-                del __thonny_st
-                del __thonny_children
-                del __thonny_name
-                del __thonny_path
-                del __thonny_full
-                del __thonny_result
-                del __thonny_real_path
-            """
+        self._ensure_file_system_helpers()
+
+        # File browser tends to ask about same directories repeatedly.
+        # The device remembers the last list, so it doesn't need to be sent again
+        # (unless the device has lost it, eg. because of soft reboot).
+        paths_repr = repr(paths)
+        # large listings are quicker to parse as JSON
+        json_value = self._supports_json()
+        if paths_repr == self._last_listed_paths_repr:
+            result = self._evaluate(
+                "__thonny_fs_helper.get_dirs_child_data(None, %d)" % self._listed_paths_generation,
+                json_value=json_value,
             )
-            % {"paths": paths}
+            if result is not None:
+                return result
+
+        # new key for the device, which identifies this list
+        self._listed_paths_generation += 1
+        self._last_listed_paths_repr = paths_repr
+        return self._evaluate(
+            "__thonny_fs_helper.get_dirs_child_data(%s, %d)"
+            % (paths_repr, self._listed_paths_generation),
+            json_value=json_value,
         )
 
+    def _supports_json(self):
+        # builtin modules may be just a fallback list, so need to ask the device
+        if self._json_supported is None:
+            self._ensure_file_system_helpers()
+            self._json_supported = self._evaluate("__thonny_fs_helper.json is not None")
+
+        return self._json_supported
+
     def _check_for_connection_errors(self):
         self._connection._check_for_error()
 
@@ -1056,29 +1296,28 @@ class MicroPythonBackend:
 
             mark_text_ranges(root, source)
 
-            expr_stmts = []
-            for node in ast.walk(root):
-                if isinstance(node, ast.Expr):
-                    expr_stmts.append(node)
-
             marker_prefix = "__thonny_helper.print_repl_value("
             marker_suffix = ")"
 
-            lines = source.splitlines(keepends=True)
-            for node in reversed(expr_stmts):
-                lines[node.end_lineno - 1] = (
-                    lines[node.end_lineno - 1][: node.end_col_offset]
-                    + marker_suffix
-                    + lines[node.end_lineno - 1][node.end_col_offset :]
-                )
-
-                lines[node.lineno - 1] = (
-                    lines[node.lineno - 1][: node.col_offset]
-                    + marker_prefix
-                    + lines[node.lineno - 1][node.col_offset :]
-                )
-
-            new_source = "".join(lines)
+            # Collect insertions as absolute offsets (known by the tokens),
+            # so that the new source can be assembled in one pass.
+            # Closing marker goes before an opening marker at the same position.
+            insertions = []
+            for node in _iter_repl_expression_statements(root.body):
+                insertions.append((node.first_token.startpos, 1, marker_prefix))
+                insertions.append((node.last_token.endpos, 0, marker_suffix))
+
+            insertions.sort()
+
+            parts = []
+            prev_pos = 0
+            for pos, _, marker in insertions:
+                parts.append(source[prev_pos:pos])
+                parts.append(marker)
+                prev_pos = pos
+            parts.append(source[prev_pos:])
+
+            new_source = "".join(parts)
             # make sure it parses
             ast.parse(new_source)
             return new_source
@@ -1092,6 +1331,33 @@ class MicroPythonBackend:
         self._prev_time = new_time
 
 
+def _iter_repl_expression_statements(statements):
+    """Yields the expression statements whose values an interactive interpreter would echo.
+
+    Like CPython's interactive mode, descends into compound statements (for, if, with, try, ...),
+    but not into function or class bodies."""
+    for stmt in statements:
+        if isinstance(stmt, ast.Expr):
+            yield stmt
+        elif not isinstance(stmt, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            for child in ast.iter_child_nodes(stmt):
+                if isinstance(child, ast.stmt):
+                    yield from _iter_repl_expression_statements([child])
+                elif isinstance(child, _STATEMENT_BLOCK_NODE_TYPES):
+                    yield from _iter_repl_expression_statements(child.body)
+
+
+# except-clauses and match-cases (Python 3.10+) are not statements, but contain statements
+_STATEMENT_BLOCK_NODE_TYPES = (ast.excepthandler,) + (
+    (ast.match_case,) if hasattr(ast, "match_case") else ()
+)
+
+
+class ConnectionActivity:
+    """Put into command queue for waking up main loop when the connection has new data
+    or got broken"""
+
+
 class ProtocolError(Exception):
     def __init__(self, message, captured):
         Exception.__init__(self, message)
@@ -1123,10 +1389,10 @@ def parse_api_information(file_path):
     for toplevel_item in tree.body:
         if isinstance(toplevel_item, ast.ClassDef):
             class_name = toplevel_item.name
-            member_names = []
+            member_names = set()
             for item in toplevel_item.body:
                 if isinstance(item, ast.FunctionDef):
-                    member_names.append(item.name)
+                    member_names.add(item.name)
                 elif isinstance(item, ast.Assign):
                     # TODO: check Python 3.4
                     "TODO: item.targets[0].id"
@@ -1136,6 +1402,48 @@ def parse_api_information(file_path):
     return defs
 
 
+def _get_existing_local_files(paths):
+    """Same as list(filter(os.path.exists, paths)), but lists each directory once
+    instead of querying each path separately"""
+    paths_by_dir = {}
+    for path in paths:
+        paths_by_dir.setdefault(os.path.dirname(path), []).append(path)
+
+    candidates = set()
+    for dir_path, dir_paths in paths_by_dir.items():
+        try:
+            # the file system may be case-insensitive, so compare loosely ...
+            names = {_loose_file_name(name) for name in os.listdir(dir_path or ".")}
+        except (FileNotFoundError, NotADirectoryError):
+            # none of these can exist
+            continue
+        except OSError:
+            # eg. a directory which can be entered but not listed
+            candidates.update(dir_paths)
+            continue
+
+        for path in dir_paths:
+            name = os.path.basename(path)
+            if _loose_file_name(name) in names or _may_exist_unlisted(name):
+                candidates.add(path)
+
+    # ... and let the file system decide about the matches
+    return [path for path in paths if path in candidates and os.path.exists(path)]
+
+
+def _may_exist_unlisted(name):
+    """Whether a path with this basename may exist even if directory listing doesn't show it"""
+    if name in ("", ".", ".."):
+        return True
+
+    # Windows also accepts short (8.3) names and ignores trailing dots and spaces
+    return os.name == "nt" and ("~" in name or name.endswith((".", " ")))
+
+
+def _loose_file_name(name):
+    return unicodedata.normalize("NFC", name).casefold()
+
+
 def linux_dirname_basename(path):
     if path == "/":
         return ("/", "")
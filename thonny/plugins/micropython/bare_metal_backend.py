@@ -13,7 +13,7 @@ from textwrap import dedent
 import re
 import os
 import time
-from thonny.misc_utils import find_volumes_by_name, sizeof_fmt
+from thonny.misc_utils import find_volumes_by_name, sizeof_fmt, TimeHelper
 import binascii
 from thonny.plugins.micropython.backend import (
     MicroPythonBackend,
@@ -31,6 +31,10 @@ from thonny.plugins.micropython.backend import (
 # and writer (SerialConnection) has it's own blocks and delays
 BUFFER_SIZE = 512
 
+# Block of BUFFER_SIZE bytes may produce a write command of this size (when every byte
+# gets escaped). Smaller commands get combined up to this size.
+MAX_WRITE_SCRIPT_SIZE = 4 * BUFFER_SIZE + 10
+
 BAUDRATE = 115200
 ENCODING = "utf-8"
 
@@ -57,6 +61,9 @@ FIRST_RAW_PROMPT_SUFFIX = b"\r\n>"
 
 RAW_PROMPT = b">"
 
+# How long to wait for the rest of a prompt, when output between commands ends with its start
+PROMPT_COMPLETION_TIMEOUT = 0.2
+
 
 FALLBACK_BUILTIN_MODULES = [
     "cmath",
@@ -93,12 +100,14 @@ FALLBACK_BUILTIN_MODULES = [
     "esp32",
 ]
 
+DEBUG = False
+
 logger = logging.getLogger("thonny.micropython.backend")
 
 
-def debug(msg):
-    return
-    print(msg, file=sys.stderr)
+def debug(*args):
+    if DEBUG:
+        print(*args, file=sys.stderr)
 
 
 class MicroPythonBareMetalBackend(MicroPythonBackend):
@@ -129,6 +138,31 @@ class MicroPythonBareMetalBackend(MicroPythonBackend):
         """
         )
 
+    def _get_file_system_helpers(self):
+        return super()._get_file_system_helpers() + dedent(
+            """
+            @classmethod
+            def makedirs(cls, path):
+                parts = path.split('/')
+                for i in range(2, len(parts) + 1):
+                    sub_path = "/".join(parts[:i])
+                    try:
+                        cls.os.stat(sub_path)
+                    except OSError:
+                        # does not exist
+                        cls.os.mkdir(sub_path)
+            
+            @classmethod
+            def delete(cls, paths):
+                for path in paths:
+                    if cls.isdir(path):
+                        cls.delete([path + "/" + name for name in cls.listdir(path)])
+                        cls.os.rmdir(path)
+                    else:
+                        cls.os.remove(path)
+        """
+        )
+
     def _process_until_initial_prompt(self, clean):
         if clean:
             self._interrupt_to_raw_prompt()
@@ -218,6 +252,9 @@ class MicroPythonBareMetalBackend(MicroPythonBackend):
         if side_command:
             self._interrupt_to_raw_prompt()
 
+        # soft reboot clears globals, file system helpers get reinstalled when needed
+        self._file_system_helpers_installed = False
+
         # Need to go to normal mode. MP doesn't run user code in raw mode
         # (CP does, but it doesn't hurt to do it there as well)
         self._connection.write(NORMAL_MODE_CMD)
@@ -255,7 +292,7 @@ class MicroPythonBareMetalBackend(MicroPythonBackend):
         # send command
         with self._writing_lock:
             self._connection.write(script.encode(ENCODING) + EOT)
-            debug("Wrote " + script + "\n--------\n")
+            debug("Wrote", script, "\n--------\n")
 
             # fetch command confirmation
             confirmation = self._connection.soft_read(2, timeout=WAIT_OR_CRASH_TIMEOUT)
@@ -281,10 +318,20 @@ class MicroPythonBareMetalBackend(MicroPythonBackend):
         assert value == b"OKFalse"
 
         with self._writing_lock:
-            self._connection.write(self._get_all_helpers().encode(ENCODING) + EOT)
+            self._connection.write(self._get_encoded_all_helpers() + EOT)
 
         out = self._connection.read_until(EOT + EOT + RAW_PROMPT)
 
+        if self._file_system_helpers_installed:
+            # Globals were cleared unexpectedly (eg. by reset button) and the command
+            # about to be submitted may be using these as well
+            with self._writing_lock:
+                self._connection.write(
+                    self._get_file_system_helpers_script().encode(ENCODING) + EOT
+                )
+
+            out = self._connection.read_until(EOT + EOT + RAW_PROMPT)
+
     def _execute_with_consumer(self, script, output_consumer):
         """Expected output after submitting the command and reading the confirmation is following:
         
@@ -482,6 +529,16 @@ class MicroPythonBareMetalBackend(MicroPythonBackend):
     def _forward_unexpected_output(self, stream_name="stdout"):
         "Invoked between commands"
         data = self._connection.read_all()
+
+        # Output gets forwarded as soon as it arrives, so the prompt after a reset may be split
+        # between several reads. Can't recognize the reset without the whole prompt.
+        timer = TimeHelper(PROMPT_COMPLETION_TIMEOUT)
+        while _ends_with_partial_prompt(data) and timer.time_left > 0:
+            more = self._connection.soft_read(1, timeout=timer.time_left)
+            if not more:
+                break
+            data += more + self._connection.read_all()
+
         at_prompt = False
 
         while data.endswith(NORMAL_PROMPT) or data.endswith(FIRST_RAW_PROMPT):
@@ -740,17 +797,40 @@ class MicroPythonBareMetalBackend(MicroPythonBackend):
                 )
             )
 
+        # Consecutive write calls are submitted together (saving round trips),
+        # as long as the script doesn't exceed what a single block could produce
         bytes_sent = 0
+        batch = []
+        batch_script_size = 0
+        batch_num_bytes = 0
+
+        def submit_batch():
+            nonlocal bytes_sent, batch, batch_script_size, batch_num_bytes
+            script = "\n".join(batch)
+            self._execute_without_output(script)
+            debug("Wrote", script)
+            bytes_sent += batch_num_bytes
+            batch = []
+            batch_script_size = 0
+            batch_num_bytes = 0
+            if notifier is not None:
+                notifier(bytes_sent)
+
         for block in content_blocks:
             if hex_mode:
                 script = "__W(%r)" % binascii.hexlify(block)
             else:
                 script = "__W(%r)" % block
-            self._execute_without_output(script)
-            print("Wrote", script)
-            bytes_sent += len(block)
-            if notifier is not None:
-                notifier(bytes_sent)
+
+            if batch and batch_script_size + len(script) > MAX_WRITE_SCRIPT_SIZE:
+                submit_batch()
+
+            batch.append(script)
+            batch_script_size += len(script) + 1
+            batch_num_bytes += len(block)
+
+        if batch:
+            submit_batch()
 
         bytes_received = self._evaluate("__thonny_written")
 
@@ -792,7 +872,8 @@ class MicroPythonBareMetalBackend(MicroPythonBackend):
         )
 
     def _makedirs(self, path):
-        if path == "/":
+        if path == "/" or path in self._known_remote_dirs:
+            # eg. when uploading several files into same directory
             return
 
         try:
@@ -800,6 +881,17 @@ class MicroPythonBareMetalBackend(MicroPythonBackend):
         except Exception as e:
             if "read-only" in str(e).lower():
                 self._makedirs_via_mount(path)
+                self._remember_remote_dir(path)
+        else:
+            self._remember_remote_dir(path)
+
+    def _remember_remote_dir(self, path):
+        # ancestors exist as well
+        while path not in self._known_remote_dirs:
+            self._known_remote_dirs.add(path)
+            if "/" not in path.rstrip("/"):
+                break
+            path, _ = linux_dirname_basename(path)
 
     def _makedirs_via_mount(self, path):
         mounted_path = self._internal_path_to_mounted_path(path)
@@ -811,30 +903,8 @@ class MicroPythonBareMetalBackend(MicroPythonBackend):
             return
         path = path.rstrip("/")
 
-        script = (
-            dedent(
-                """
-            import os as __thonny_helper.os
-            __thonny_parts = %r.split('/')
-            for i in range(2, len(__thonny_parts) + 1):
-                __thonny_path = "/".join(__thonny_parts[:i])
-                try:
-                    __thonny_helper.os.stat(__thonny_path)
-                except OSError:
-                    # does not exist
-                    __thonny_helper.os.mkdir(__thonny_path)
-            
-            del __thonny_parts
-            try:
-                del __thonny_path
-            except:
-                pass
-        """
-            )
-            % path
-        )
-
-        self._execute_without_output(script)
+        self._ensure_file_system_helpers()
+        self._execute_without_output("__thonny_fs_helper.makedirs(%r)" % path)
 
     def _delete_via_mount(self, paths):
         for path in paths:
@@ -845,44 +915,9 @@ class MicroPythonBareMetalBackend(MicroPythonBackend):
             shutil.rmtree(mounted_path)
 
     def _delete_via_serial(self, paths):
-        if not self._supports_directories():
-            self._execute_without_output(
-                dedent(
-                    """
-                import os as __thonny_helper.os
-                for __thonny_path in %r: 
-                    __thonny_helper.os.remove(__thonny_path)
-                    
-                del __thonny_path
-                
-            """
-                )
-                % paths
-            )
-        else:
-            self._execute_without_output(
-                dedent(
-                    """
-                import os as __thonny_helper.os
-                def __thonny_delete(path):
-                    if __thonny_helper.os.stat(path)[0] & 0o170000 == 0o040000:
-                        for name in __thonny_helper.os.listdir(path):
-                            child_path = path + "/" + name
-                            __thonny_delete(child_path)
-                        __thonny_helper.os.rmdir(path)
-                    else:
-                        __thonny_helper.os.remove(path)
-                
-                for __thonny_path in %r: 
-                    __thonny_delete(__thonny_path)
-                    
-                del __thonny_path
-                del __thonny_delete
-                
-            """
-                )
-                % paths
-            )
+        self._ensure_file_system_helpers()
+        # without directory support isdir is always false, so delete only removes files
+        self._execute_without_output("__thonny_fs_helper.delete(%r)" % (paths,))
 
     def _upload_file(self, source, target, notifier):
         assert target.startswith("/") or not self._supports_directories()
@@ -1016,6 +1051,18 @@ def _ends_overlap(left, right):
     return False
 
 
+def _ends_with_partial_prompt(data):
+    """Whether data ends with a line starting like a prompt, but not the whole prompt"""
+    for prompt in (NORMAL_PROMPT, FIRST_RAW_PROMPT):
+        for size in range(1, len(prompt)):
+            if data.endswith(prompt[:size]) and (
+                len(data) == size or data[-size - 1 : -size] == LF
+            ):
+                return True
+
+    return False
+
+
 if __name__ == "__main__":
     THONNY_USER_DIR = os.environ["THONNY_USER_DIR"]
     logger = logging.getLogger("thonny.micropython.backend")
@@ -22,6 +22,7 @@ class MicroPythonConnection:
         self._read_buffer = bytearray()  # used for unreading and postponing bytes
         self.num_bytes_received = 0
         self._error = None
+        self._activity_listener = None  # gets called in reader thread
 
     def soft_read(self, size, timeout=1):
         return self.read(size, timeout, True)
@@ -109,6 +110,19 @@ class MicroPythonConnection:
         finally:
             self._read_buffer = bytearray()
 
+    def set_activity_listener(self, listener):
+        """Listener gets called (in reader thread) when new data arrives or the connection
+        breaks"""
+        self._activity_listener = listener
+
+    def _notify_activity(self):
+        if self._activity_listener is not None:
+            self._activity_listener()
+
+    def _set_error(self, error):
+        self._error = error
+        self._notify_activity()
+
     def _check_for_error(self):
         if self._error is None:
             return
@@ -136,6 +150,7 @@ class MicroPythonConnection:
     def _make_output_available(self, data, block=True):
         # self._log_data(data)
         self._read_queue.put(data, block=block)
+        self._notify_activity()
 
     def incoming_is_empty(self):
         return self._read_queue.empty() and len(self._read_buffer) == 0
@@ -36,7 +36,7 @@ class MicroPythonOsBackend(MicroPythonBackend):
     def _get_custom_helpers(self):
         return textwrap.dedent(
             """
-            if not hasattr(os, "getcwd") or not hasattr(os, "getcwd") or not hasattr(os, "rmdir"):
+            if not hasattr(os, "getcwd") or not hasattr(os, "chdir") or not hasattr(os, "rmdir"):
                 # https://github.com/pfalcon/pycopy-lib/blob/master/os/os/__init__.py
                 
                 import ffi
@@ -64,7 +64,7 @@ class MicroPythonOsBackend(MicroPythonBackend):
                 
                 _rmdir = libc.func("i", "rmdir", "s")
                 @classmethod
-                def rmdir(cls.name):
+                def rmdir(cls, name):
                     e = cls._rmdir(name)
                     cls.check_error(e)                                    
                 """
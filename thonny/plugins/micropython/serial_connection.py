@@ -68,7 +68,7 @@ class SerialConnection(MicroPythonConnection):
             while True:
                 data += self._serial.read(1)  # To avoid busy loop
                 if len(data) == 0:
-                    self._error = "EOF"
+                    self._set_error("EOF")
                     # print("LISTEN EOFFFFFFFFFF")
                     break
                 data += self._serial.read_all()
@@ -93,7 +93,7 @@ class SerialConnection(MicroPythonConnection):
                     self._make_output_available(to_be_published)
 
         except Exception as e:
-            self._error = str(e)
+            self._set_error(str(e))
 
     def incoming_is_empty(self):
         return self._serial.in_waiting == 0 and super().incoming_is_empty()
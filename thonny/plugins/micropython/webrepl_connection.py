@@ -83,7 +83,7 @@ class WebReplConnection(MicroPythonConnection):
         while True:
             data = (await self._ws.recv()).encode("UTF-8")
             if len(data) == 0:
-                self._error = "EOF"
+                self._set_error("EOF")
                 break
 
             self.num_bytes_received += len(data)
@@ -175,12 +175,12 @@ class alt_WebReplConnection(MicroPythonConnection):
                 self._ws.settimeout(10)
                 data = self._ws.recv().encode("UTF-8")
                 if len(data) == 0:
-                    self._error = "EOF"
+                    self._set_error("EOF")
                     break
                 self._make_output_available(data)
                 self.num_bytes_received += len(data)
         except Exception as e:
-            self._error = str(e)
+            self._set_error(str(e))
 
     def write(self, data, block_size=255, delay=0.01):
         debug("Writing", len(data), repr(data))
@@ -0,0 +1,76 @@
+import os
+
+from thonny.plugins.micropython import backend
+from thonny.plugins.micropython.backend import _get_existing_local_files
+
+
+def test_get_existing_local_files(tmp_path):
+    (tmp_path / "sub").mkdir()
+    existing = [str(tmp_path / "a.py"), str(tmp_path / "sub" / "b.py")]
+    for path in existing:
+        open(path, "w").close()
+
+    paths = existing + [
+        str(tmp_path / "missing.py"),
+        str(tmp_path / "sub" / "missing.py"),
+        str(tmp_path / "missing_dir" / "c.py"),
+        str(tmp_path / "a.py" / "d.py"),
+    ]
+
+    assert _get_existing_local_files(paths) == list(filter(os.path.exists, paths))
+    assert _get_existing_local_files(paths) == existing
+
+
+def test_get_existing_local_files_in_unlistable_dir(tmp_path, monkeypatch):
+    # eg. a directory with mode --x, which can be entered but not listed
+    path = str(tmp_path / "a.py")
+    open(path, "w").close()
+
+    def listdir(path):
+        raise PermissionError(path)
+
+    monkeypatch.setattr(backend.os, "listdir", listdir)
+
+    assert _get_existing_local_files([path, str(tmp_path / "missing.py")]) == [path]
+
+
+def _create_bare_metal_backend_for_forwarding():
+    from thonny.plugins.micropython.bare_metal_backend import MicroPythonBareMetalBackend
+    from thonny.plugins.micropython.connection import MicroPythonConnection
+
+    # not connecting to a device, only the parts needed for forwarding output
+    backend = MicroPythonBareMetalBackend.__new__(MicroPythonBareMetalBackend)
+    backend._connection = MicroPythonConnection()
+    backend.outputs = []
+    backend.messages = []
+    backend._send_output = lambda data, stream_name: backend.outputs.append(data)
+    backend.send_message = backend.messages.append
+    return backend
+
+
+def test_forward_unexpected_output_recognizes_split_prompt():
+    import threading
+    from thonny.common import ToplevelResponse
+
+    backend = _create_bare_metal_backend_for_forwarding()
+    connection = backend._connection
+
+    # reset button pressed, the prompt arrives in two chunks
+    connection._make_output_available(b"MicroPython v1.13\r\n>>")
+    threading.Timer(0.05, connection._make_output_available, [b"> "]).start()
+
+    backend._forward_unexpected_output()
+
+    assert "".join(backend.outputs) == "MicroPython v1.13\r\n"
+    assert len(backend.messages) == 1
+    assert isinstance(backend.messages[0], ToplevelResponse)
+
+
+def test_forward_unexpected_output_without_rest_of_prompt():
+    backend = _create_bare_metal_backend_for_forwarding()
+
+    backend._connection._make_output_available(b"data\n>")
+    backend._forward_unexpected_output()
+
+    assert "".join(backend.outputs) == "data\n>"
+    assert backend.messages == []
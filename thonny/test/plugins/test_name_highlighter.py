@@ -1,5 +1,4 @@
-import tkinter
-from typing import Sequence, Set  # @UnusedImport
+from typing import FrozenSet, Sequence  # @UnusedImport
 
 from thonny.plugins.highlight_names import VariablesHighlighter
 import sys
@@ -42,16 +41,16 @@ CURSOR_POSITIONS1 = (
     ("14.5",),
 )
 
-EXPECTED_INDICES1 = [
-    {("1.4", "1.7"), ("2.4", "2.7")},
-    {("4.4", "4.7"), ("9.4", "9.7")},
-    set(),
-    {("5.4", "5.7"), ("6.10", "6.13")},
-    {("4.8", "4.12"), ("7.10", "7.14")},
-    {("10.0", "10.4")},
-    {("12.4", "12.5"), ("12.8", "12.9")},
-    {("14.4", "14.5")},
-]  # type: Sequence[Set[Sequence[str]]]
+EXPECTED_INDICES1 = (
+    frozenset({("1.4", "1.7"), ("2.4", "2.7")}),
+    frozenset({("4.4", "4.7"), ("9.4", "9.7")}),
+    frozenset(),
+    frozenset({("5.4", "5.7"), ("6.10", "6.13")}),
+    frozenset({("4.8", "4.12"), ("7.10", "7.14")}),
+    frozenset({("10.0", "10.4")}),
+    frozenset({("12.4", "12.5"), ("12.8", "12.9")}),
+    frozenset({("14.4", "14.5")}),
+)  # type: Sequence[FrozenSet[Sequence[str]]]
 
 TEST_STR2 = """import too
 def foo():
@@ -67,11 +66,54 @@ class TestClass:
 """
 CURSOR_POSITIONS2 = (("1.8", "3.10"), ("2.4", "2.5", "11.10"), ("3.5", "4.9"))
 EXPECTED_INDICES2 = (
-    {("1.7", "1.10"), ("3.10", "3.13")},
-    {("2.4", "2.7"), ("11.8", "11.11")},
-    {("3.4", "3.7"), ("4.8", "4.11")},
+    frozenset({("1.7", "1.10"), ("3.10", "3.13")}),
+    frozenset({("2.4", "2.7"), ("11.8", "11.11")}),
+    frozenset({("3.4", "3.7"), ("4.8", "4.11")}),
 )
 
+
+class FakeText:
+    """Provides the parts of tkinter.Text used by the name highlighter,
+    so that the tests don't need a display"""
+
+    def __init__(self):
+        self._content = ""
+        self._marks = {"insert": "1.0"}
+
+    def insert(self, index, chars):
+        assert index == "end"
+        self._content += chars
+
+    def mark_set(self, mark_name, index):
+        self._marks[mark_name] = index
+
+    def index(self, index):
+        return self._marks.get(index, index)
+
+    def get(self, index1, index2):
+        # Text widget always keeps a newline at the end
+        content = self._content + "\n"
+        return content[self._get_offset(index1) : self._get_offset(index2)]
+
+    def _get_offset(self, index):
+        if index == "end":
+            return len(self._content) + 1
+
+        delta = 0
+        for suffix in ["-1c", "+1c"]:
+            if index.endswith(suffix):
+                index = index[: -len(suffix)]
+                delta = int(suffix[:-1])
+
+        line, column = map(int, index.split("."))
+        lines = self._content.splitlines(keepends=True)
+        offset = sum(map(len, lines[: line - 1])) + column + delta
+        return max(0, min(offset, len(self._content) + 1))
+
+    def tag_prevrange(self, tag_name, index):
+        return ()
+
+
 TEST_GROUPS = (
     (CURSOR_POSITIONS1, EXPECTED_INDICES1, TEST_STR1),
     (CURSOR_POSITIONS2, EXPECTED_INDICES2, TEST_STR2),
@@ -99,16 +141,38 @@ def test_all():
         _assert_returns_correct_indices(test[0], test[1], test[2])
 
 
+def test_positions_follow_edits(monkeypatch):
+    from thonny import jedi_utils
+    from thonny.plugins import highlight_names
+
+    # normally imported by update_highlighting
+    monkeypatch.setattr(highlight_names, "tree", jedi_utils.import_python_tree())
+
+    text_widget = FakeText()
+    text_widget.insert("end", "x = 1\nprint(x)\n")
+    nh = VariablesHighlighter(text_widget)
+
+    # same name under both cursor positions
+    assert nh.get_positions_batch(["1.0", "1.1"]) == [
+        frozenset({("1.0", "1.1"), ("2.6", "2.7")}),
+        frozenset({("1.0", "1.1"), ("2.6", "2.7")}),
+    ]
+
+    text_widget._content = "x = 1\ny = x\nprint(x)\n"
+    nh.invalidate_source()
+    assert nh.get_positions_batch(["1.0", "2.0"]) == [
+        frozenset({("1.0", "1.1"), ("2.4", "2.5"), ("3.6", "3.7")}),
+        frozenset({("2.0", "2.1")}),
+    ]
+
+
 def _assert_returns_correct_indices(insert_pos_groups, expected_indices, input_str):
-    text_widget = tkinter.Text()
+    text_widget = FakeText()
     text_widget.insert("end", input_str)
 
     nh = VariablesHighlighter(text_widget)
     for i, group in enumerate(insert_pos_groups):
-        for insert_pos in group:
-            text_widget.mark_set("insert", insert_pos)
-
-            actual = nh.get_positions()
+        for insert_pos, actual in zip(group, nh.get_positions_batch(group)):
             expected = expected_indices[i]
 
             assert actual == expected, (